@@ -1,14 +1,10 @@
-import os
-import sys
-
 from flask import Blueprint
 
 
-HERE = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, HERE)
 DEFAULT_COUNTRY_CODE = "NL"
 DEFAULT_COUNTRY_TIMEZONE = "Europe/Amsterdam"  # This is what we receive, even if ENTSO-E documents Europe/Brussels
 DEFAULT_DERIVED_DATA_SOURCE = "FlexMeasures ENTSO-E"
+DEFAULT_CACHE_DIR = "~/.cache/flexmeasures-entsoe"
 
 __version__ = "0.8"
 __settings__ = {
@@ -38,6 +34,11 @@ __settings__ = {
         level="info",
         message_if_missing=f"'{DEFAULT_DERIVED_DATA_SOURCE}' will be used as a default.",
     ),
+    "ENTSOE_CACHE_DIR": dict(
+        description="Directory in which to cache ENTSO-E data about past periods.",
+        level="debug",
+        message_if_missing=f"'{DEFAULT_CACHE_DIR}' will be used as a default.",
+    ),
 }
 
 entsoe_data_bp = Blueprint("entsoe", __name__, cli_group="entsoe")
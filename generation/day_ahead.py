@@ -1,13 +1,11 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Optional, Tuple
 from datetime import datetime
+import asyncio
 
 import click
 from flask.cli import with_appcontext
 from flask import current_app
-import entsoe
-from entsoe import EntsoePandasClient
-
-# from entsoe.entsoe import URL
+import numpy as np
 import pandas as pd
 from flexmeasures.data.transactional import task_with_status_report
 
@@ -22,15 +20,18 @@ from ..utils import (
     ensure_country_code_and_timezone,
     ensure_data_source,
     ensure_data_source_for_derived_data,
-    get_auth_token_from_config_and_set_server_url,
     abort_if_data_empty,
     parse_from_and_to_dates_default_today_and_tomorrow,
-    save_entsoe_series,
+    save_entsoe_data,
     ensure_sensors,
     resample_if_needed,
     start_import_log,
+    with_entsoe_cache,
 )
 
+if TYPE_CHECKING:
+    from entsoe import EntsoePandasClient
+
 
 """
 Get the CO₂ content from tomorrow's generation forecasts.
@@ -53,6 +54,22 @@ kg_CO2_per_MWh = dict(
     wind_offshore=17,  # factor of ~ 1.1, see https://www.mdpi.com/2071-1050/10/6/2022
 )
 
+grey_CO2_intensity_factor = (  # TODO: a factor per hour of the day
+    (grey_energy_mix["coal"] * kg_CO2_per_MWh["coal"])
+    + (grey_energy_mix["gas"] * kg_CO2_per_MWh["gas"])
+    + (grey_energy_mix["oil"] * kg_CO2_per_MWh["oil"])
+)
+
+# Columns of the green generation forecast, and their kg CO₂ per MWh (in the same order)
+green_generation_columns = ["Solar", "Wind Onshore", "Wind Offshore"]
+green_kg_CO2_per_MWh = np.array(
+    [
+        kg_CO2_per_MWh["solar"] / 1000.0,
+        kg_CO2_per_MWh["wind_onshore"],
+        kg_CO2_per_MWh["wind_offshore"],
+    ]
+)
+
 
 @entsoe_data_bp.cli.command("import-day-ahead-generation")
 @click.option(
@@ -72,6 +89,18 @@ kg_CO2_per_MWh = dict(
     default=False,
     help="In dry run mode, do not save the data to the db.",
 )
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    help="Cache data about past periods on disk, and read it from there on later runs.",
+)
+@click.option(
+    "--refresh-cache/--no-refresh-cache",
+    "refresh_cache",
+    default=False,
+    help="Query ENTSO-E again for data about past periods, and update the cache with the result (e.g. after ENTSO-E republished data).",
+)
 @click.option(
     "--country",
     "country_code",
@@ -88,6 +117,8 @@ kg_CO2_per_MWh = dict(
 @task_with_status_report("entsoe-import-day-ahead-generation")
 def import_day_ahead_generation(
     dryrun: bool = False,
+    use_cache: bool = True,
+    refresh_cache: bool = False,
     from_date: Optional[datetime] = None,
     to_date: Optional[datetime] = None,
     country_code: Optional[str] = None,
@@ -114,95 +145,114 @@ def import_day_ahead_generation(
     client = create_entsoe_client()
     log, now = start_import_log("day-ahead generation", from_time, until_time, country_code, country_timezone)
 
-    log.info("Getting scheduled generation ...")
-    # We assume that the green (solar & wind) generation is not included in this (it is not scheduled)
-    scheduled_generation: pd.Series = client.query_generation_forecast(
-        country_code, start=from_time, end=until_time
+    log.info("Getting scheduled and green generation ...")
+    scheduled_generation, green_generation_df = asyncio.run(
+        query_generation_forecasts(
+            client, country_code, from_time, until_time, use_cache, refresh_cache
+        )
     )
     abort_if_data_empty(scheduled_generation)
-    log.debug("Overall aggregated generation: \n%s" % scheduled_generation)
+    log.debug("Overall aggregated generation: \n%s", scheduled_generation)
 
     scheduled_generation = resample_if_needed(
         scheduled_generation,
         sensors["Scheduled generation"],
     )
 
-    log.info("Getting green generation ...")
-    green_generation_df: pd.DataFrame = client.query_wind_and_solar_forecast(
-        country_code, start=from_time, end=until_time, psr_type=None
-    )
     abort_if_data_empty(green_generation_df)
-    log.debug("Green generation: \n%s" % green_generation_df)
-
-    log.info("Aggregating green energy columns ...")
-    all_green_generation = green_generation_df.sum(axis="columns")
-    log.debug("Aggregated green generation: \n%s" % all_green_generation)
-
-    log.info("Computing combined generation forecast ...")
-    all_generation = scheduled_generation + all_green_generation
-    log.debug("Combined generation: \n%s" % all_generation)
+    log.debug("Green generation: \n%s", green_generation_df)
 
-    log.info("Computing CO₂ content from the MWh values ...")
-    co2_in_kg = calculate_CO2_content_in_kg(scheduled_generation, green_generation_df)
-    log.debug("Overall CO₂ content (kg): \n%s" % co2_in_kg)
+    log.info("Computing combined generation forecast and its CO₂ content ...")
+    all_generation, co2_in_kg = calculate_generation_and_CO2_content_in_kg(
+        scheduled_generation, green_generation_df
+    )
+    log.debug("Combined generation: \n%s", all_generation)
+    log.debug("Overall CO₂ content (kg): \n%s", co2_in_kg)
     forecasted_kg_CO2_per_MWh = co2_in_kg / all_generation
-    log.debug("Overall CO₂ content (kg/MWh): \n%s" % forecasted_kg_CO2_per_MWh)
-
-    def get_series_for_sensor(sensor):
-        if sensor.name == "Scheduled generation":
-            return scheduled_generation
-        elif sensor.name == "Solar":
-            return green_generation_df["Solar"]
-        elif sensor.name == "Wind Onshore":
-            return green_generation_df["Wind Onshore"]
-        elif sensor.name == "Wind Offshore":
-            return green_generation_df["Wind Offshore"]
-        elif sensor.name == "CO₂ intensity":
-            return forecasted_kg_CO2_per_MWh
-        else:
-            log.error(f"Cannot connect data to sensor {sensor.name}.")
-            raise click.Abort
+    log.debug("Overall CO₂ content (kg/MWh): \n%s", forecasted_kg_CO2_per_MWh)
+
+    series_by_sensor_name = {
+        "Scheduled generation": scheduled_generation,
+        "Solar": green_generation_df["Solar"],
+        "Wind Onshore": green_generation_df["Wind Onshore"],
+        "Wind Offshore": green_generation_df["Wind Offshore"],
+        "CO₂ intensity": forecasted_kg_CO2_per_MWh,
+    }
 
     if not dryrun:
+        data_to_save = []
         for sensor in sensors.values():
-            series = get_series_for_sensor(sensor)
-            log.info(f"Saving {len(series)} beliefs for Sensor {sensor.name} ...")
-            series.name = "event_value"  # required by timely_beliefs, TODO: check if that still is the case, see https://github.com/SeitaBV/timely-beliefs/issues/64
+            series = series_by_sensor_name.get(sensor.name)
+            if series is None:
+                log.error(f"Cannot connect data to sensor {sensor.name}.")
+                raise click.Abort
             entsoe_source = (
                 entsoe_data_source if sensor.data_by_entsoe else derived_data_source
             )
-            save_entsoe_series(series, sensor, entsoe_source, country_timezone, now)
+            data_to_save.append((series, sensor, entsoe_source))
+        save_entsoe_data(data_to_save, now)
 
 
-def calculate_CO2_content_in_kg(
-    grey_generation: pd.Series, green_generation: pd.DataFrame
-) -> pd.Series:
-    grey_CO2_intensity_factor = (  # TODO: a factor per hour of the day
-        (grey_energy_mix["coal"] * kg_CO2_per_MWh["coal"])
-        + (grey_energy_mix["gas"] * kg_CO2_per_MWh["gas"])
-        + (grey_energy_mix["oil"] * kg_CO2_per_MWh["oil"])
-    )
-    current_app.logger.debug(f"Grey intensity factor: {grey_CO2_intensity_factor}")
-    grey_CO2_content = grey_generation * grey_CO2_intensity_factor
-    current_app.logger.debug("Grey CO₂ content (tonnes): \n%s" % grey_CO2_content)
-
-    green_generation["solar CO₂"] = (
-        green_generation["Solar"] * kg_CO2_per_MWh["solar"] / 1000.0
+async def query_generation_forecasts(
+    client: "EntsoePandasClient",
+    country_code: str,
+    from_time: pd.Timestamp,
+    until_time: pd.Timestamp,
+    use_cache: bool = True,
+    refresh_cache: bool = False,
+) -> Tuple[pd.Series, pd.DataFrame]:
+    """
+    Query the scheduled generation and the green generation forecasts concurrently.
+    Both are independent requests to ENTSO-E, so we only need to wait for the slowest one.
+    """
+    query_generation_forecast = with_entsoe_cache(
+        client.query_generation_forecast, use_cache, refresh_cache
     )
-    green_generation["wind_onshore CO₂"] = (
-        green_generation["Wind Onshore"] * kg_CO2_per_MWh["wind_onshore"]
+    query_wind_and_solar_forecast = with_entsoe_cache(
+        client.query_wind_and_solar_forecast, use_cache, refresh_cache
     )
-    green_generation["wind_offshore CO₂"] = (
-        green_generation["Wind Offshore"] * kg_CO2_per_MWh["wind_offshore"]
+    # We assume that the green (solar & wind) generation is not included in the scheduled generation (it is not scheduled)
+    scheduled_generation, green_generation_df = await asyncio.gather(
+        asyncio.to_thread(
+            query_generation_forecast,
+            country_code,
+            start=from_time,
+            end=until_time,
+        ),
+        asyncio.to_thread(
+            query_wind_and_solar_forecast,
+            country_code,
+            start=from_time,
+            end=until_time,
+            psr_type=None,
+        ),
     )
+    return scheduled_generation, green_generation_df
 
-    current_app.logger.debug(
-        "Green generation and CO₂ content: \n%s" % green_generation
-    )
+
+def calculate_generation_and_CO2_content_in_kg(
+    grey_generation: pd.Series, green_generation: pd.DataFrame
+) -> Tuple[pd.Series, pd.Series]:
+    """
+    Compute the combined (grey and green) generation and its CO₂ content in kg,
+    indexed like the grey generation. The green generation columns are read only once, for both.
+    """
+    log = current_app.logger
+    grey_generation_values = grey_generation.to_numpy(dtype=np.float64)
+
+    # Align the green generation to the grey generation, then sum and weigh its columns in one go
+    green_generation_values = green_generation.reindex(grey_generation.index)[
+        green_generation_columns
+    ].to_numpy(dtype=np.float64)
+    all_generation = grey_generation_values + green_generation_values.sum(axis=1)
+
+    log.debug("Grey intensity factor: %s", grey_CO2_intensity_factor)
+    grey_CO2_content = grey_generation_values * grey_CO2_intensity_factor
+    log.debug("Grey CO₂ content (kg): \n%s", grey_CO2_content)
+    green_CO2_content = green_generation_values @ green_kg_CO2_per_MWh
+    log.debug("Green CO₂ content (kg): \n%s", green_CO2_content)
 
     return (
-        grey_CO2_content
-        + green_generation["solar CO₂"]
-        + green_generation["wind_onshore CO₂"]
-        + green_generation["wind_offshore CO₂"]
+        pd.Series(all_generation, index=grey_generation.index),
+        pd.Series(grey_CO2_content + green_CO2_content, index=grey_generation.index),
     )
@@ -7,8 +7,6 @@ from flask import current_app
 import pandas as pd
 from flexmeasures import Source, Sensor
 
-import entsoe
-from entsoe import EntsoePandasClient
 from flexmeasures.data.transactional import task_with_status_report
 
 from flexmeasures.data.schemas import (
@@ -30,9 +28,9 @@ from ..utils import (
     parse_from_and_to_dates_default_today_and_tomorrow,
     ensure_sensors,
     save_entsoe_series,
-    get_auth_token_from_config_and_set_server_url,
     abort_if_data_empty,
     start_import_log,
+    with_entsoe_cache,
 )
 
 
@@ -54,6 +52,18 @@ from ..utils import (
     default=False,
     help="In dry run mode, do not save the data to the db.",
 )
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    help="Cache data about past periods on disk, and read it from there on later runs.",
+)
+@click.option(
+    "--refresh-cache/--no-refresh-cache",
+    "refresh_cache",
+    default=False,
+    help="Query ENTSO-E again for data about past periods, and update the cache with the result (e.g. after ENTSO-E republished data).",
+)
 @click.option(
     "--country",
     "country_code",
@@ -84,6 +94,8 @@ from ..utils import (
 @task_with_status_report("entsoe-import-day-ahead-prices")
 def import_day_ahead_prices(
     dryrun: bool = False,
+    use_cache: bool = True,
+    refresh_cache: bool = False,
     from_date: Optional[datetime] = None,
     to_date: Optional[datetime] = None,
     country_code: Optional[str] = None,
@@ -122,13 +134,11 @@ def import_day_ahead_prices(
     log, now = start_import_log("day-ahead price", from_time, until_time, country_code, country_timezone)
 
     log.info("Getting prices ...")
-    prices: pd.Series = client.query_day_ahead_prices(
-        country_code, start=from_time, end=until_time
-    )
+    prices: pd.Series = with_entsoe_cache(
+        client.query_day_ahead_prices, use_cache, refresh_cache
+    )(country_code, start=from_time, end=until_time)
     abort_if_data_empty(prices)
-    log.debug("Prices: \n%s" % prices)
+    log.debug("Prices: \n%s", prices)
 
     if not dryrun:
-        log.info(f"Saving {len(prices)} beliefs for Sensor {pricing_sensor.name} ...")
-        prices.name = "event_value"  # required by timely_beliefs, TODO: check if that still is the case, see https://github.com/SeitaBV/timely-beliefs/issues/64
-        save_entsoe_series(prices, pricing_sensor, entsoe_data_source, country_timezone, now)
+        save_entsoe_series(prices, pricing_sensor, entsoe_data_source, now)
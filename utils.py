@@ -1,14 +1,19 @@
-from typing import Dict, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 from datetime import datetime
+from functools import lru_cache, wraps
 from logging import Logger
+import hashlib
+import math
+import os
+import pickle
+import stat
+import tempfile
 
-from entsoe import EntsoePandasClient
 from flask import current_app
 from pandas.tseries.frequencies import to_offset
 import pandas as pd
 import click
 import pytz
-import entsoe
 
 from flexmeasures.data.utils import get_data_source, save_to_db
 from flexmeasures import Asset, AssetType, Sensor, Source
@@ -17,46 +22,103 @@ from flexmeasures.utils.time_utils import server_now
 from timely_beliefs import BeliefsDataFrame
 
 from . import (
+    DEFAULT_CACHE_DIR,
     DEFAULT_DERIVED_DATA_SOURCE,
     DEFAULT_COUNTRY_CODE,
     DEFAULT_COUNTRY_TIMEZONE,
 )  # noqa: E402
 
+if TYPE_CHECKING:
+    from entsoe import EntsoePandasClient
 
-def ensure_data_source() -> Source:
+# A calendar day instead of just 24 hours, from https://github.com/gweis/isodate/pull/64
+one_calendar_day = pd.offsets.DateOffset(days=1)
+
+
+def remember_ensured_id(model, matches: Callable[..., bool]) -> Callable:
+    """
+    Decorator for ensure_* functions, remembering the id of the object they ensured.
+    Later calls with the same arguments (within the same process) get the object by its primary key,
+    which is cheap (or even free, if the session still holds it), instead of looking it up by name again.
+
+    An id may point to another row by now (e.g. after the database was recreated, or when switching databases),
+    so the object is only used if matches(obj, *args) confirms it is still the one the arguments ask for.
+    Otherwise (or if the object no longer exists), the decorated function is called as usual.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        ensured_ids: Dict[tuple, int] = {}
+
+        @wraps(func)
+        def wrapper(*args):
+            obj = None
+            if args in ensured_ids:
+                obj = db.session.get(model, ensured_ids[args])
+                if obj is not None and not matches(obj, *args):
+                    obj = None
+            if obj is None:
+                obj = func(*args)
+                if obj.id is not None:  # new objects only get an id once flushed
+                    ensured_ids[args] = obj.id
+            return obj
+
+        return wrapper
+
+    return decorator
+
+
+@remember_ensured_id(
+    Source,
+    matches=lambda source, data_source_name: source.name == data_source_name
+    and source.type == "forecasting script",
+)
+def ensure_named_data_source(data_source_name: str) -> Source:
     return get_data_source(
-        data_source_name="ENTSO-E",
+        data_source_name=data_source_name,
         data_source_type="forecasting script",
     )
 
 
+def ensure_data_source() -> Source:
+    return ensure_named_data_source("ENTSO-E")
+
+
 def ensure_data_source_for_derived_data() -> Source:
-    return get_data_source(
-        data_source_name=current_app.config.get(
+    return ensure_named_data_source(
+        current_app.config.get(
             "ENTSOE_DERIVED_DATA_SOURCE", DEFAULT_DERIVED_DATA_SOURCE
-        ),
-        data_source_type="forecasting script",
+        )
     )
 
 
+def get_transmission_zone_asset_name(country_code: str) -> str:
+    return f"{country_code} transmission zone"
+
+
+@remember_ensured_id(
+    Asset,
+    matches=lambda asset, country_code: asset.name
+    == get_transmission_zone_asset_name(country_code),
+)
 def ensure_transmission_zone_asset(country_code: str) -> Asset:
     """
     Ensure a GenericAsset exists to model the transmission zone for which this plugin gathers data.
     """
+    log = current_app.logger
     transmission_zone_type = AssetType.query.filter(
         AssetType.name == "transmission zone"
     ).one_or_none()
     if not transmission_zone_type:
-        current_app.logger.info("Adding transmission zone type ...")
+        log.info("Adding transmission zone type ...")
         transmission_zone_type = AssetType(
             name="transmission zone",
             description="A grid regulated & balanced as a whole, usually a national grid.",
         )
         db.session.add(transmission_zone_type)
-    ga_name = f"{country_code} transmission zone"
+    ga_name = get_transmission_zone_asset_name(country_code)
     transmission_zone = Asset.query.filter(Asset.name == ga_name).one_or_none()
     if not transmission_zone:
-        current_app.logger.info(f"Adding {ga_name} ...")
+        log.info(f"Adding {ga_name} ...")
         transmission_zone = Asset(
             name=ga_name,
             generic_asset_type=transmission_zone_type,
@@ -78,17 +140,26 @@ def ensure_sensors(
 
     If new sensors got created, the session has been flushed.
     """
+    log = current_app.logger
     sensors = {}
-    sensors_created: bool = False
-    transmission_zone = ensure_transmission_zone_asset(country_code)
+    new_sensors = []
+    # Look up the sensors via the name of their asset, so that we only need to ensure the asset if sensors are missing
+    existing_sensors = {
+        (sensor.name, sensor.unit): sensor
+        for sensor in Sensor.query.join(Asset, Sensor.generic_asset)
+        .filter(
+            Asset.name == get_transmission_zone_asset_name(country_code),
+            Sensor.name.in_([spec[0] for spec in sensor_specifications]),
+        )
+        .all()
+    }
+    transmission_zone = None
     for sensor_name, unit, event_resolution, data_by_entsoe in sensor_specifications:
-        sensor = Sensor.query.filter(
-            Sensor.name == sensor_name,
-            Sensor.unit == unit,
-            Sensor.generic_asset == transmission_zone,
-        ).one_or_none()
+        sensor = existing_sensors.get((sensor_name, unit))
         if not sensor:
-            current_app.logger.info(f"Adding sensor {sensor_name} ...")
+            if transmission_zone is None:
+                transmission_zone = ensure_transmission_zone_asset(country_code)
+            log.info(f"Adding sensor {sensor_name} ...")
             sensor = Sensor(
                 name=sensor_name,
                 unit=unit,
@@ -96,34 +167,48 @@ def ensure_sensors(
                 timezone=timezone,
                 event_resolution=event_resolution,
             )
-            db.session.add(sensor)
-            sensors_created = True
+            new_sensors.append(sensor)
         sensor.data_by_entsoe = data_by_entsoe
         sensors[sensor_name] = sensor
-    if sensors_created:
+    if new_sensors:
+        db.session.add_all(new_sensors)
         db.session.flush()
     return sensors
 
 
-def get_auth_token_from_config_and_set_server_url() -> str:
+def use_test_server() -> bool:
+    return current_app.config.get("ENTSOE_USE_TEST_SERVER", False)
+
+
+def get_auth_token_from_config() -> str:
     """
     Read ENTSOE auth token from config, raise if not given.
     If test server is supposed to be used, we'll try to read the token
-    usable for that, and also change the URL.
+    usable for that.
     """
-    use_test_server = current_app.config.get("ENTSOE_USE_TEST_SERVER", False)
-    if use_test_server:
+    if use_test_server():
         auth_token = current_app.config.get("ENTSOE_AUTH_TOKEN_TEST_SERVER")
-        entsoe.entsoe.URL = "https://iop-transparency.entsoe.eu/api"
     else:
         auth_token = current_app.config.get("ENTSOE_AUTH_TOKEN")
-        entsoe.entsoe.URL = "https://web-api.tp.entsoe.eu/api"
     if not auth_token:
         click.echo("Setting ENTSOE_AUTH_TOKEN seems empty!")
         raise click.Abort
     return auth_token
 
 
+def set_entsoe_server_url():
+    """
+    Point entsoe-py to the test server, if that is supposed to be used, or otherwise to the production server.
+    This sets a global in entsoe-py, so it only needs to happen once before querying.
+    """
+    import entsoe  # imported on demand, so loading this plugin does not require importing entsoe-py
+
+    if use_test_server():
+        entsoe.entsoe.URL = "https://iop-transparency.entsoe.eu/api"
+    else:
+        entsoe.entsoe.URL = "https://web-api.tp.entsoe.eu/api"
+
+
 def ensure_country_code_and_timezone(
     country_code: Optional[str] = None,
     country_timezone: Optional[str] = None,
@@ -139,12 +224,111 @@ def ensure_country_code_and_timezone(
     return country_code, country_timezone
 
 
-def create_entsoe_client() -> EntsoePandasClient:
-    auth_token = get_auth_token_from_config_and_set_server_url()
+@lru_cache(maxsize=32)
+def get_timezone(timezone: str) -> pytz.BaseTzInfo:
+    return pytz.timezone(timezone)
+
+
+def create_entsoe_client() -> "EntsoePandasClient":
+    from entsoe import EntsoePandasClient
+
+    auth_token = get_auth_token_from_config()
+    set_entsoe_server_url()
     client = EntsoePandasClient(api_key=auth_token)
     return client
 
 
+def is_private_cache_file(cache_file: str) -> bool:
+    """
+    Unpickling a file can run arbitrary code, so we only trust cache files that were not written by someone else.
+    That is, the file and its directory should be owned by the current user and not be writable by others.
+    """
+    for path in (cache_file, os.path.dirname(cache_file)):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return False
+        if hasattr(os, "getuid") and path_stat.st_uid != os.getuid():
+            return False
+        if path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+    return True
+
+
+def with_entsoe_cache(
+    query: Callable, use_cache: bool = True, refresh_cache: bool = False
+) -> Callable:
+    """
+    Wrap a query method of the ENTSO-E client, so that its results are cached on disk.
+    Only data about periods which lie entirely in the past is cached, as it rarely changes afterwards.
+    That makes re-running imports for past dates (e.g. when backfilling) a lot faster.
+    ENTSO-E does sometimes republish (corrected) data, though, so with refresh_cache we skip reading the cache,
+    query ENTSO-E again and overwrite the cache with the fresh result.
+
+    Create the wrapper within the app context; the wrapped query can then also be called from other threads.
+    """
+    if not use_cache:
+        return query
+    import entsoe
+
+    cache_dir = os.path.expanduser(
+        current_app.config.get("ENTSOE_CACHE_DIR", DEFAULT_CACHE_DIR)
+    )
+    server_url = entsoe.entsoe.URL
+    log = current_app.logger
+    now = server_now()
+
+    @wraps(query)
+    def cached_query(
+        country_code: str, start: pd.Timestamp, end: pd.Timestamp, **kwargs
+    ):
+        if end > now:
+            return query(country_code, start=start, end=end, **kwargs)
+        key = f"{server_url} {query.__name__} {country_code} {start.isoformat()} {end.isoformat()} {sorted(kwargs.items())}"
+        cache_file = os.path.join(
+            cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pkl"
+        )
+        if not refresh_cache and os.path.exists(cache_file):
+            if not is_private_cache_file(cache_file):
+                log.warning(
+                    f"Ignoring cache file {cache_file}, as it (or its directory) is not private to the current user."
+                )
+            else:
+                try:
+                    data = pd.read_pickle(cache_file)
+                    log.debug(
+                        f"Read {query.__name__} data from cache file {cache_file}."
+                    )
+                    return data
+                except (
+                    pickle.UnpicklingError,
+                    EOFError,
+                    AttributeError,
+                    ImportError,
+                    OSError,
+                ) as e:  # e.g. a corrupt file, or written by another pandas version
+                    log.warning(f"Could not read cache file {cache_file}: {e}")
+        data = query(country_code, start=start, end=end, **kwargs)
+        if not data.empty:
+            tmp_path = None
+            try:
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                # Write to a temporary file first, so no half-written cache file is ever left behind
+                with tempfile.NamedTemporaryFile(
+                    dir=cache_dir, suffix=".tmp", delete=False
+                ) as tmp_file:
+                    tmp_path = tmp_file.name
+                    data.to_pickle(tmp_file)
+                os.replace(tmp_path, cache_file)
+            except OSError as e:  # e.g. no writable cache dir, or a full disk
+                log.warning(f"Could not write cache file {cache_file}: {e}")
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return data
+
+    return cached_query
+
+
 def abort_if_data_empty(data: Union[pd.DataFrame, pd.Series]):
     if data.empty:
         click.echo(
@@ -160,19 +344,16 @@ def parse_from_and_to_dates_default_today_and_tomorrow(
     Parse CLI options (or set default to today and tomorrow)
     Note:  entsoe-py expects time params as pd.Timestamp
     """
-    today_start = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    tz = get_timezone(country_timezone)
+    today_start = pd.Timestamp.now(tz=tz).normalize()
     if to_date is None:
-        to_date = pd.Timestamp(
-            today_start, tzinfo=pytz.timezone(country_timezone)
-        ) + pd.offsets.DateOffset(
-            days=1
-        )  # Add a calendar day instead of just 24 hours, from https://github.com/gweis/isodate/pull/64
+        to_date = today_start + one_calendar_day
     else:
-        to_date = pd.Timestamp(to_date, tzinfo=pytz.timezone(country_timezone))
+        to_date = pd.Timestamp(to_date, tz=tz)
     if from_date is None:
-        from_date = pd.Timestamp(today_start, tzinfo=pytz.timezone(country_timezone))
+        from_date = today_start
     else:
-        from_date = pd.Timestamp(from_date, tzinfo=pytz.timezone(country_timezone))
+        from_date = pd.Timestamp(from_date, tz=tz)
     from_time, until_time = date_range_to_time_range(from_date, to_date)
     return from_time, until_time
 
@@ -184,48 +365,71 @@ def parse_from_and_to_dates_default_yesterday(
     Parse CLI options (or set default to yesterday)
     Note:  entsoe-py expects time params as pd.Timestamp
     """
+    tz = get_timezone(country_timezone)
     if from_date is None:
-        today_start = datetime.today().replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        from_date = pd.Timestamp(
-            today_start, tzinfo=pytz.timezone(country_timezone)
-        ) - pd.offsets.DateOffset(
-            days=1
-        )  # Deduct a calendar day instead of just 24 hours, from https://github.com/gweis/isodate/pull/64
+        today_start = pd.Timestamp.now(tz=tz).normalize()
+        from_date = today_start - one_calendar_day
     else:
-        from_date = pd.Timestamp(from_date, tzinfo=pytz.timezone(country_timezone))
+        from_date = pd.Timestamp(from_date, tz=tz)
     if to_date is None:
         to_date = from_date
     else:
-        to_date = pd.Timestamp(to_date, tzinfo=pytz.timezone(country_timezone))
+        to_date = pd.Timestamp(to_date, tz=tz)
     from_time, until_time = date_range_to_time_range(from_date, to_date)
     return from_time, until_time
 
 
+def is_regular_grid(index: pd.DatetimeIndex) -> bool:
+    """Cheap check (without a full scan) whether an index of at least two timestamps looks like a regular grid.
+    Its first and last steps should be equal, and the step should also fit the middle and the whole span of the index.
+
+    This is a heuristic: uneven steps elsewhere may still cancel out, so a False result is certain, but a True result is not.
+    """
+    step = index[1] - index[0]
+    middle = len(index) // 2
+    return (
+        step > pd.Timedelta(0)
+        and index[-1] - index[-2] == step
+        and index[middle] - index[0] == step * middle
+        and index[-1] - index[0] == step * (len(index) - 1)
+    )
+
+
 def resample_if_needed(s: pd.Series, sensor: Sensor) -> pd.Series:
-    inferred_frequency = pd.infer_freq(s.index)
+    log = current_app.logger
+    # ENTSO-E resolutions differ per zone and over time, so we go by the data itself
+    if s.index.freq is not None:
+        inferred_frequency = s.index.freq  # already known, no need to scan the index
+    elif len(s.index) > 2 and is_regular_grid(s.index):
+        inferred_frequency = s.index[1] - s.index[0]
+    else:
+        inferred_frequency = pd.infer_freq(s.index)
     if inferred_frequency is None:
         raise ValueError(
             "Data has no discernible frequency from which to derive an event resolution."
         )
-    inferred_resolution = pd.to_timedelta(to_offset(inferred_frequency))
+    if isinstance(inferred_frequency, pd.Timedelta):
+        inferred_resolution = inferred_frequency  # no need to go via an offset
+    else:
+        inferred_resolution = pd.to_timedelta(to_offset(inferred_frequency))
     target_resolution = sensor.event_resolution
     if inferred_resolution == target_resolution:
         return s
     elif inferred_resolution > target_resolution:
-        current_app.logger.debug(f"Upsampling data for {sensor.name} ...")
+        log.debug(f"Upsampling data for {sensor.name} ...")
         index = pd.date_range(
             s.index[0],
-            s.index[-1] + inferred_resolution,
+            periods=math.ceil(
+                (s.index[-1] + inferred_resolution - s.index[0]) / target_resolution
+            ),
             freq=target_resolution,
-            closed="left",
         )
-        s = s.reindex(index).pad()
+        # Fill gaps at the (coarser) source resolution, then pad while reindexing
+        s = s.ffill().reindex(index, method="pad")
     elif inferred_resolution < target_resolution:
-        current_app.logger.debug(f"Downsampling data for {sensor.name} ...")
+        log.debug(f"Downsampling data for {sensor.name} ...")
         s = s.resample(target_resolution).mean()
-    current_app.logger.debug(f"Resampled data for {sensor.name}: \n%s" % s)
+    log.debug("Resampled data for %s: \n%s", sensor.name, s)
     return s
 
 
@@ -233,41 +437,62 @@ def save_entsoe_series(
     series: pd.Series,
     sensor: Sensor,
     entsoe_source: Source,
-    country_timezone: str,
-    now: Optional[datetime] = None,
+    now: datetime,
 ):
     """
     Save a series gotten from ENTSO-E to a FlexMeasures database.
     """
-    if not now:
-        now = server_now().astimezone(pytz.timezone(country_timezone))
-    belief_times = (
-        (series.index.floor("D") - pd.Timedelta("6h"))
-        .to_frame(name="clipped_belief_times")
-        .clip(upper=now)
-        .set_index("clipped_belief_times")
-        .index
-    )  # published no later than D-1 18:00 Brussels time
-    bdf = BeliefsDataFrame(
-        series,
-        source=entsoe_source,
-        sensor=sensor,
-        belief_time=belief_times,
-    )
+    save_entsoe_data([(series, sensor, entsoe_source)], now)
+
+
+def save_entsoe_data(
+    data: List[Tuple[pd.Series, Sensor, Source]],
+    now: datetime,
+):
+    """
+    Save series gotten from ENTSO-E to a FlexMeasures database, for several sensors at once.
+    Each series comes with the sensor to save it to, and the source of the data.
+    The time of the import (now) caps the belief times, and is best determined once by the caller.
+    """
+    log = current_app.logger
+    bdfs = []
+    for series, sensor, entsoe_source in data:
+        if series.isna().all():  # also true if the series is empty
+            log.info(f"Nothing to save for Sensor {sensor.name}.")
+            continue
+        log.info(f"Saving {len(series)} beliefs for Sensor {sensor.name} ...")
+        belief_times = series.index.floor("D") - pd.Timedelta(
+            "6h"
+        )  # published no later than D-1 18:00 Brussels time
+        belief_time_cap = pd.Timestamp(now).tz_convert(belief_times.tz)
+        belief_times = belief_times.where(
+            belief_times <= belief_time_cap, belief_time_cap
+        )
+        # naming the values "event_value" is required by timely_beliefs, TODO: check if that still is the case, see https://github.com/SeitaBV/timely-beliefs/issues/64
+        bdfs.append(
+            BeliefsDataFrame(
+                series.rename("event_value"),
+                source=entsoe_source,
+                sensor=sensor,
+                belief_time=belief_times,
+            )
+        )
+    if not bdfs:
+        return
 
     # TODO: evaluate some traits of the data via FlexMeasures, see https://github.com/SeitaBV/flexmeasures-entsoe/issues/3
-    status = save_to_db(bdf)
+    status = save_to_db(bdfs)
     if status == "success_but_nothing_new":
-        current_app.logger.info("Done. These beliefs had already been saved before.")
+        log.info("Done. These beliefs had already been saved before.")
     elif status == "success_with_unchanged_beliefs_skipped":
-        current_app.logger.info("Done. Some beliefs had already been saved before.")
+        log.info("Done. Some beliefs had already been saved before.")
 
 
 def date_range_to_time_range(
     from_date: pd.Timestamp, to_date: pd.Timestamp
 ) -> Tuple[pd.Timestamp, pd.Timestamp]:
     """Because to_date is inclusive, we add one calendar day."""
-    return from_date, to_date + pd.offsets.DateOffset(days=1)
+    return from_date, to_date + one_calendar_day
 
 
 def start_import_log(
@@ -277,9 +502,11 @@ def start_import_log(
     country_code: str,
     country_timezone: str,
 ) -> Tuple[Logger, datetime]:
+    import entsoe
+
     log = current_app.logger
     log.info(
         f"Importing {import_type} data for {country_code} (timezone {country_timezone}), starting at {from_time}, up until {until_time}, from ENTSO-E at {entsoe.entsoe.URL} ..."
     )
-    now = server_now().astimezone(pytz.timezone(country_timezone))
+    now = server_now()
     return log, now